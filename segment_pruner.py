@@ -5,7 +5,11 @@
 # https://docs.datacroft.de/main-functions/segment-pruner
 import copy
 import datetime as dt
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from json import dumps
+import numpy as np
 import aanalytics2 as aa2
 
 ags = aa2.Login() # READ NEXT ROWS!
@@ -18,11 +22,33 @@ ags = aa2.Login() # READ NEXT ROWS!
 
 rs_id = "the_report_suite_id"
 seg_id = "s3537_646796b50f59414c34dcacbf"
+# any number of metrics, e.g. ["metrics/visits", "metrics/visitors", "metrics/orders", "metrics/revenue", "metrics/event12"]
 metric_ids = ["metrics/occurrences", "metrics/orders"]
+# optional tolerances per metric: ("absolute", 0.01) or ("relative", 0.001). Metrics not listed here must match exactly
+metric_tolerances = {}
 days_back = 90
+# Segments shared across report suites: a candidate is only removable if the data stays identical in every report suite
+# and every date window (days back from today) listed here. Each combination of the two is called a "scope".
+rs_ids = [rs_id]
+days_back_windows = [days_back]
+max_workers = 8  # max. number of report requests running in parallel
+# Audit mode: if segment IDs are listed here, the building blocks shared by these segments (e.g. bot exclusions or
+# country lists) are evaluated only once and the results are reused in every segment that contains them.
+# `seg_id` is not pruned in this mode.
+audit_seg_ids = []
+audit_top_n = 20  # number of most frequent shared subtrees to list in the audit report
 # 'func' values that indicate a group of elements e.g. "container") and not an actual filter (e.g. "page == home")
 grouping_functions = ["segment", "container", "and", "or", "without", "sequence", "sequence-prefix",
                       "sequence-suffix", "sequence-and", "sequence-or"]
+# in segment definitions, equals any of needs a "," as a separator, contains any of needs a " " as a separator (legacy nonsense)
+delimiter_map = {
+    "contains-any-of": " ",
+    "streq-in": ",",
+    "not-contains-any-of": " ",
+    "not-streq-in": ","
+}
+# keys that do not change which data a segment element returns. They are ignored when comparing subtrees across segments
+digest_ignored_keys = ["_id", "description"]
 
 # finds and returns a subdictionary with a certain key inside of a multi-nested dictionary, e.g. "_id = 7"
 def find_subdictionary_by_id(d: dict = None, target_id: int = None, key: str = "_id"):
@@ -132,21 +158,43 @@ def at_least_once_in_dict(key: str = None, values_whitelist: list = None, dct: d
     return False  # if we get here, no key-value pair of the desired key-value combination was found
 
 
-# assigns incrementing IDs with key "_id" to all dictionaries found. Also traverses lists for that
-def assign_ids_recursive(data, id_counter=None):
+# returns a canonical copy of a segment subtree, so that subtrees filtering the same data look the same: metadata keys
+# are dropped, the values of multi-value components are sorted and deduplicated and the elements of "and"/"or" groups
+# are sorted (their order does not matter, unlike e.g. in sequences)
+def canonicalize_subtree(d):
+    if isinstance(d, dict):
+        canonical = {k: canonicalize_subtree(v) for k, v in d.items() if k not in digest_ignored_keys}
+        if (canonical.get("func") in delimiter_map.keys()) and isinstance(canonical.get("list"), list):
+            canonical["list"] = sorted(set(canonical["list"]))
+        if (canonical.get("func") in ["and", "or"]) and isinstance(canonical.get("preds"), list):
+            canonical["preds"] = sorted(canonical["preds"], key=lambda el: dumps(el, sort_keys=True))
+        return canonical
+    elif isinstance(d, list):
+        return [canonicalize_subtree(v) for v in d]
+    else:
+        return d
+
+
+# assigns incrementing IDs with key "_id" to all dictionaries found. Also traverses lists for that.
+# If a `digests` dict is passed, it is filled with a canonical digest of each dictionary's subtree by _id,
+# so identical subtrees get the same digest, no matter in which segment they are found
+def assign_ids_recursive(data, id_counter=None, digests: dict = None):
     if id_counter is None:
         id_counter = {'_id': 0}
 
     if isinstance(data, dict):
+        if digests is not None:  # the subtree does not have any _ids yet at this point
+            digests[id_counter['_id']] = hashlib.sha1(
+                dumps(canonicalize_subtree(data), sort_keys=True).encode()).hexdigest()
         data['_id'] = id_counter['_id']  # Assign ID to current dictionary
         id_counter['_id'] += 1
 
         for value in data.values():
-            assign_ids_recursive(value, id_counter)  # Recursively process sub-dictionaries
+            assign_ids_recursive(value, id_counter, digests)  # Recursively process sub-dictionaries
 
     elif isinstance(data, list):
         for item in data:
-            assign_ids_recursive(item, id_counter)  # Recursively process list items
+            assign_ids_recursive(item, id_counter, digests)  # Recursively process list items
 
 
 # Finds empty preds [] and writes the _ids of their parent dictionary into a list so we can delete them via delete_subdict_by_id
@@ -225,112 +273,406 @@ def slice_up_segment(dfn: dict = None, components: list = None, alt_definitions:
             iterator += 1
             slice_up_segment(el, components, alt_definitions, original_seg_wrk, iterator)
 
+# collects all segment elements (the container and everything below it via "pred" and "preds") into `nodes`
+def collect_seg_nodes(d: dict = None, nodes: list = None):
+    nodes.append(d)
+    if d.get("pred") is not None:
+        collect_seg_nodes(d["pred"], nodes)
+    elif d.get("preds") is not None:
+        for el in d["preds"]:
+            collect_seg_nodes(el, nodes)
+
+
+report_call_counter = {"count": 0}  # number of report requests sent to AA
+report_call_lock = threading.Lock()
+# one pool for all report requests, so no more than `max_workers` requests ever run at the same time
+report_executor = ThreadPoolExecutor(max_workers=max_workers)
+
+
+# gets the report for the request `_req` and counts the request
+def get_report(_req: dict = None):
+    with report_call_lock:
+        report_call_counter["count"] += 1
+    return ags.getReport2(request=_req).dataframe
+
+
 # Takes an original request `_req` and modifies the segment definition by the `seg_defi` provided to then get the data for that alternative segment
 def get_comp_report(seg_defi: dict = None, _req: dict = None):
     if _req["globalFilters"][0].get("segmentId") is not None:
         del _req["globalFilters"][0]["segmentId"]
     # replace with the new segment definition
     _req["globalFilters"][0]["segmentDefinition"] = seg_defi["definition"]
-    return ags.getReport2(request=_req).dataframe
-
-# compares the dataframe with the report for of the current segment definition with the data of the alternative segment definition
-def compare_data(_comp_data, _current_data):
-    curr_metric1 = _current_data[metric_ids[0]].sum()
-    comp_metric1 = _comp_data[metric_ids[0]].sum()
-    curr_metric2 = _current_data[metric_ids[1]].sum()
-    comp_metric2 = _comp_data[metric_ids[1]].sum()
-    if curr_metric1 != comp_metric1:
-        # if the 2 metrics differ between the two segment definitions
-        word = "not identical"
-        if comp_metric1 == 0:  # special case: the new segment is empty (= actually also not identical, can be discarded as a solution)
-            print("The new segment definition returns no data.")
-            return "zero"
-    else:
-        # if there is no difference for the first metric between the two segment definitions, we check the other metric
-        if curr_metric2 == comp_metric2:
-            word = "identical"
+    return get_report(_req=_req)
+
+# returns the totals of all `metric_ids` in a report as a NumPy vector (one entry per metric)
+def get_totals(data):
+    return data[metric_ids].sum().to_numpy(dtype=float)
+
+
+# builds the vectors of absolute and relative tolerances (one entry per metric) from `metric_tolerances`
+def build_tolerance_vectors():
+    abs_tol = np.zeros(len(metric_ids))
+    rel_tol = np.zeros(len(metric_ids))
+    for ind, metric_id in enumerate(metric_ids):
+        tol_type, tol_value = metric_tolerances.get(metric_id, ("absolute", 0))
+        if tol_type == "absolute":
+            abs_tol[ind] = tol_value
+        elif tol_type == "relative":
+            rel_tol[ind] = tol_value
         else:
-            word = f"nearly identical, but {metric_ids[1]} are not"
+            raise Exception(f"Unknown tolerance type '{tol_type}' for metric {metric_id}!")
+    return abs_tol, rel_tol
+
+
+# compares the totals of a variant to the baseline totals, all metrics at once. Returns "identical" if every metric is
+# within its tolerance, "zero" if the variant returns no data at all (= actually also not identical, can be discarded
+# as a solution), "not identical" otherwise
+def compare_totals(comp_totals, baseline_totals):
+    if (np.abs(comp_totals - baseline_totals) <= abs_tolerances + rel_tolerances * np.abs(baseline_totals)).all():
+        return "identical"
+    if not comp_totals.any():
+        return "zero"
+    return "not identical"
+
+
+# compares the dataframe with the report of the alternative segment definition to the baseline totals of the current segment definition
+def compare_data(_comp_data, _baseline_totals):
+    comp_totals = get_totals(_comp_data)
+    word = compare_totals(comp_totals, _baseline_totals)
+    if word == "zero":
+        print("The new segment definition returns no data.")
+        return word
     print(
-        f"The new segment definition ({comp_metric1}) is {word} to the original segment definition ({curr_metric1}).")
+        f"The new segment definition ({dict(zip(metric_ids, comp_totals.tolist()))}) is {word} to the original "
+        f"segment definition ({dict(zip(metric_ids, _baseline_totals.tolist()))}).")
 
     return word
 
 
-# get the original segment
-original_seg = ags.getSegment(segment_id=seg_id, full=True)
+# returns the date range string for the last `_days_back` days, e.g. "2023-05-03T00:00:00.000/2023-05-10T00:00:00.000"
+def get_date_str(_days_back: int = None):
+    now = dt.datetime.now()
+    start_date = now - dt.timedelta(days=_days_back)
+    end_date_str = now.strftime(
+        '%Y-%m-%d') + 'T00:00:00.000'  # today at 00.00.00.000 is how the interface does it. I guess data source hits are stored at 00:00:00.000 so the result is not the same as 23:59:59.000
+    start_date_str = start_date.strftime('%Y-%m-%d') + 'T00:00:00.000'
+    return f"{start_date_str}/{end_date_str}"
 
-original_seg_wrk = copy.deepcopy(original_seg)  # working copy
-now = dt.datetime.now()
-start_date = now - dt.timedelta(days=days_back)
-end_date_str = now.strftime(
-    '%Y-%m-%d') + 'T00:00:00.000'  # today at 00.00.00.000 is how the interface does it. I guess data source hits are stored at 00:00:00.000 so the result is not the same as 23:59:59.000
-start_date_str = start_date.strftime('%Y-%m-%d') + 'T00:00:00.000'
-date_str = f"{start_date_str}/{end_date_str}"
-req = {
-    "rsid": rs_id,
-    "globalFilters": [
-        {
-            "type": "segment",
-            "segmentId": seg_id
-        },
-        {
-            "type": "dateRange",
-            "dateRange": date_str,  # "2023-05-03T00:00:00.000/2023-05-10T00:00:00.000",
-            "dateRangeId": "5c9760285849420dfc8b406e"
-        }
-    ],
-    "metricContainer": {
-        "metrics": [
-            {
-                "columnId": f"{metric_ids[0]}:::0",
-                "id": f"{metric_ids[0]}",
-                "filters": [
-                    "1"
-                ]
-            },
-            {
-                "columnId": f"{metric_ids[1]}",
-                "id": f"{metric_ids[1]}",
-                "filters": [
-                    "1"
-                ]
-            },
 
-        ],
-        "metricFilters": [
+# builds the report request for the segment `_seg_id` in report suite `_rs_id` and date range `_date_str`
+def build_req(_rs_id: str = None, _date_str: str = None, _seg_id: str = None):
+    return {
+        "rsid": _rs_id,
+        "globalFilters": [
             {
-                "id": "1",
                 "type": "segment",
-                "segmentId": "All_Visits"
-            }
-        ]
-    },
-    "settings": {
-        "countRepeatInstances": True,
-        "includeAnnotations": True,
-        "dimensionSort": "asc"
-    },
-    "statistics": {
-        "functions": [
-            "col-max",
-            "col-min"
-        ]
-    },
-    "capacityMetadata": {
-        "associations": [
+                "segmentId": _seg_id
+            },
             {
-                "name": "applicationName",
-                "value": "Analysis Workspace UI"
+                "type": "dateRange",
+                "dateRange": _date_str,  # "2023-05-03T00:00:00.000/2023-05-10T00:00:00.000",
+                "dateRangeId": "5c9760285849420dfc8b406e"
             }
-        ]
+        ],
+        "metricContainer": {
+            "metrics": [
+                {
+                    "columnId": f"{metric_id}:::{ind}",
+                    "id": f"{metric_id}",
+                    "filters": [
+                        "1"
+                    ]
+                } for ind, metric_id in enumerate(metric_ids)
+            ],
+            "metricFilters": [
+                {
+                    "id": "1",
+                    "type": "segment",
+                    "segmentId": "All_Visits"
+                }
+            ]
+        },
+        "settings": {
+            "countRepeatInstances": True,
+            "includeAnnotations": True,
+            "dimensionSort": "asc"
+        },
+        "statistics": {
+            "functions": [
+                "col-max",
+                "col-min"
+            ]
+        },
+        "capacityMetadata": {
+            "associations": [
+                {
+                    "name": "applicationName",
+                    "value": "Analysis Workspace UI"
+                }
+            ]
+        }
     }
-}
-# query the benchmark report
-current_data = ags.getReport2(req).dataframe
 
-current_metric1 = current_data.loc[0, metric_ids[0]]
-current_metric2 = current_data.loc[0, metric_ids[1]]
+
+# builds one report request per scope (= combination of report suite and date window) for the segment `_seg_id`.
+# The keys are readable scope labels like "my_rsid | 2023-05-03T00:00:00.000/2023-05-10T00:00:00.000"
+def build_scope_reqs(_seg_id: str = None):
+    scope_reqs = {}
+    for _rs_id in rs_ids:
+        for _days_back in days_back_windows:
+            _date_str = get_date_str(_days_back)
+            scope_reqs[f"{_rs_id} | {_date_str}"] = build_req(_rs_id=_rs_id, _date_str=_date_str, _seg_id=_seg_id)
+    return scope_reqs
+
+
+# gets the report of every scope in parallel. If `seg_defi` is None, the segment referenced in the requests is used
+# (= the benchmark), otherwise the segment definition in `seg_defi`
+def get_scope_reports(_scope_reqs: dict = None, seg_defi: dict = None):
+    futures = {}
+    for scope, _req in _scope_reqs.items():
+        if seg_defi is None:
+            futures[scope] = report_executor.submit(get_report, copy.deepcopy(_req))
+        else:
+            futures[scope] = report_executor.submit(get_comp_report, seg_defi, copy.deepcopy(_req))
+    return {scope: future.result() for scope, future in futures.items()}
+
+
+# compares the data of an alternative segment definition to the baseline totals in every scope in parallel.
+# Returns "identical" only if compare_data says so for all scopes. As soon as one scope differs, the requests for
+# the other scopes that have not started yet are cancelled and the verdict of the differing scope is returned
+# (after the requests that were already running have finished). Also returns the reports received so far (by scope).
+def compare_across_scopes(seg_defi: dict = None, _baseline_totals: dict = None, _scope_reqs: dict = None):
+    comp_data_by_scope = {}
+    futures = {report_executor.submit(get_comp_report, seg_defi, copy.deepcopy(_scope_reqs[scope])): scope
+               for scope in _baseline_totals}
+    for future in as_completed(futures):
+        scope = futures[future]
+        comp_data_by_scope[scope] = future.result()
+        result = compare_data(comp_data_by_scope[scope], _baseline_totals[scope])
+        if result != "identical":
+            print(f"Data differs in scope '{scope}', cancelling the outstanding requests for this candidate.")
+            for other_future in futures:
+                other_future.cancel()  # only possible for requests that have not started yet
+            wait(futures)
+            return result, comp_data_by_scope
+    return "identical", comp_data_by_scope
+
+
+# sums up the metrics of each scope's report so they can be logged and dumped as JSON
+def sum_by_scope(data_by_scope: dict = None):
+    return {scope: dict(zip(metric_ids, get_totals(data).tolist())) for scope, data in data_by_scope.items()}
+
+
+# builds a test segment (based on the segment `seg_tpl`) that consists only of the component `comp` in a hits container,
+# so the component can be evaluated on its own
+def build_component_test_seg(comp: dict = None, seg_tpl: dict = None):
+    test_seg = copy.deepcopy(seg_tpl)
+    test_seg["name"] = f"Test Segment for component evaluation {dt.datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    test_seg["definition"]["container"] = {
+        "func": "container",
+        "context": "hits",
+        "pred": copy.deepcopy(comp)
+    }
+    # we are actually evaluating this segment in AA, so the _id keys must go
+    delete_keys_from_dict(test_seg, _key="_id")
+    return test_seg
+
+
+# returns the totals of the component `comp` evaluated on its own in every scope
+def get_component_totals(comp: dict = None, seg_tpl: dict = None, _scope_reqs: dict = None):
+    comp_data = get_scope_reports(_scope_reqs=_scope_reqs, seg_defi=build_component_test_seg(comp, seg_tpl))
+    return {scope: get_totals(data) for scope, data in comp_data.items()}
+
+
+# prunes the list of a multi-value component (eg contains-any-of) by removing one value at a time. A value stays only
+# if removing it changes the data of the component in at least one scope. Returns the old and new definition of the component
+def prune_multival_component(comp: dict = None, seg_tpl: dict = None, baseline_totals: dict = None,
+                             _scope_reqs: dict = None) -> dict:
+    func = comp.get("func", "")
+    var = comp.get("description", comp.get("val", {}).get("name", "no_name"))
+    list_len = len(comp.get('list', []))
+    comp_copy = copy.deepcopy(comp)
+    _id = comp_copy.get("_id", -1)
+    if _id == -1:
+        raise Exception(f"Component {comp_copy} has no _id!")
+
+    shortened_comp = {"old_definition": copy.deepcopy(comp_copy),
+                      "new_definition": copy.deepcopy(comp_copy),
+                      "_id": _id}
+    shortened_comp["new_definition"]["list"] = []  # clear list first
+    shortened_comp["old_definition_str"] = delimiter_map[func].join(shortened_comp["old_definition"]["list"])
+    test_seg = build_component_test_seg(comp_copy, seg_tpl)
+    # remove duplicates
+    comp_copy["list"] = list(set(comp_copy["list"]))
+    if len(comp_copy["list"]) < list_len:
+        print(f"Removed {list_len - len(comp_copy['list'])} duplicates from component {var}")
+
+    original_list = comp_copy["list"].copy()
+    for index, value in enumerate(original_list):
+        value_to_test = original_list[index]
+        print(f"Testing without value: {value_to_test} (value {index + 1} of {list_len})")
+        shorter_list = comp_copy["list"].copy()
+        shorter_list.remove(value_to_test)  # [index + 1:]
+        test_seg["definition"]["container"]["pred"]["list"] = shorter_list
+        result, _ = compare_across_scopes(seg_defi=test_seg, _baseline_totals=baseline_totals,
+                                          _scope_reqs=_scope_reqs)
+        if result == "identical":
+            print(f"'{value_to_test}' can be removed from the component without changing the data.")
+            comp_copy["list"].remove(value_to_test)
+        else:  # keep it
+            shortened_comp["new_definition"]["list"].append(value_to_test)
+            print(f"'{value_to_test}' has to stay in the filter.")
+
+        # we are done iterating through the multi-value lists of the component
+    print(f"Done pruning the {func} values of component {var}")
+    shortened_comp["new_definition_str"] = delimiter_map[func].join(shortened_comp["new_definition"]["list"])
+    shortened_comp["new_definition"]["_id"] = _id  # re-add the ID
+    new_len = len(shortened_comp["new_definition"]["list"])
+    if new_len == list_len:
+        print(f"Component {var} could not be pruned, all values are needed.")
+        shortened_comp["pruned"] = False
+    else:
+        print(f"Component {var} can be pruned from {list_len} to {new_len} values.")
+        shortened_comp["pruned"] = True
+        shortened_comp["pruned_by"] = list_len - new_len
+    return shortened_comp
+
+
+# Audit mode: loads all segments in `_seg_ids`, finds the subtrees they share (via the digests of assign_ids_recursive)
+# and evaluates each distinct component only once: does it return data at all, and can its multi-value list be pruned?
+# The results are reused in every segment containing the component. Afterwards, each segment with pruned multi-value
+# lists is confirmed against its own benchmark data. Prints a report of the most frequent shared subtrees and the report calls saved.
+def run_audit(_seg_ids: list = None):
+    audit_segs = []
+    subtree_index = {}  # digest => subtree, number of occurrences and segments containing it
+    for _seg_id in _seg_ids:
+        seg_wrk = ags.getSegment(segment_id=_seg_id, full=True)
+        digests = {}
+        assign_ids_recursive(seg_wrk, digests=digests)
+        nodes = []
+        collect_seg_nodes(seg_wrk["definition"]["container"], nodes)
+        parent_ids = {}  # _id of an element => _id of the group it is in
+        for node in nodes:
+            children = [node["pred"]] if node.get("pred") is not None else node.get("preds", [])
+            for child in children:
+                parent_ids[child["_id"]] = node["_id"]
+        for node in nodes:
+            digest = digests[node["_id"]]
+            if digest not in subtree_index:
+                subtree = copy.deepcopy(node)
+                delete_keys_from_dict(subtree)
+                subtree_index[digest] = {"digest": digest, "subtree": subtree, "occurrences": 0, "seg_ids": [],
+                                         "parent_digests": []}
+            subtree_index[digest]["occurrences"] += 1
+            parent_id = parent_ids.get(node["_id"])
+            subtree_index[digest]["parent_digests"].append(None if parent_id is None else digests[parent_id])
+            if _seg_id not in subtree_index[digest]["seg_ids"]:
+                subtree_index[digest]["seg_ids"].append(_seg_id)
+        audit_segs.append({"seg_id": _seg_id, "seg_wrk": seg_wrk, "digests": digests, "nodes": nodes})
+        print(f"Loaded segment {_seg_id} with {len(nodes)} elements.")
+
+    shared_subtrees = [entry for entry in subtree_index.values() if len(entry["seg_ids"]) > 1]
+    print(f"Found {len(shared_subtrees)} subtrees that are shared by at least 2 of the {len(_seg_ids)} segments.")
+    # for the report, we only want the largest shared subtrees: a subtree whose parent is always shared by the
+    # same segments (e.g. a condition in a shared bot exclusion container) is already covered by its parent
+    top_shared_subtrees = [entry for entry in shared_subtrees if any(
+        (parent_digest is None) or (set(subtree_index[parent_digest]["seg_ids"]) != set(entry["seg_ids"]))
+        for parent_digest in entry["parent_digests"])]
+    top_shared_subtrees.sort(key=lambda entry: (len(entry["seg_ids"]), entry["occurrences"]), reverse=True)
+
+    # components are evaluated with their segment definition, so the segment ID in these requests is replaced anyway
+    comp_scope_reqs = build_scope_reqs(_seg_id=_seg_ids[0])
+    comp_results = {}  # digest => evaluation result of the component
+    report_calls_saved = 0
+    for audit_seg in audit_segs:
+        audit_seg["zero_data_comps"] = []
+        audit_seg["shortened_multival_comps"] = []
+        for node in audit_seg["nodes"]:
+            if (node.get("pred") is not None) or (node.get("preds") is not None) or \
+                    (node.get("func") in grouping_functions) or (node.get("stream") is not None):
+                continue  # not a component, but a group of elements (e.g. a sequence with its steps in "stream")
+            digest = audit_seg["digests"][node["_id"]]
+            if digest in comp_results:
+                print(f"Reusing the result for component {digest[:10]} in segment {audit_seg['seg_id']}.")
+                report_calls_saved += comp_results[digest]["report_calls"]
+            else:
+                calls_before = report_call_counter["count"]
+                comp_results[digest] = {"zero_data": False, "shortened_comp": None}
+                # the component is evaluated on its own in a hits container, which is not valid for every component
+                validation = ags.createSegmentValidate(
+                    segmentJSON=build_component_test_seg(comp=node, seg_tpl=audit_seg["seg_wrk"]))
+                if validation.get("errorCode") is not None:
+                    print(f"Error validating component {digest[:10]} on its own, skipping it: {validation}")
+                    comp_results[digest]["report_calls"] = 0
+                    continue
+                baseline_totals = get_component_totals(comp=node, seg_tpl=audit_seg["seg_wrk"],
+                                                       _scope_reqs=comp_scope_reqs)
+                if not any(totals.any() for totals in baseline_totals.values()):
+                    print(f"Component {digest[:10]} returns no data in any scope.")
+                    comp_results[digest]["zero_data"] = True
+                elif (node.get("func", "") in delimiter_map.keys()) and (len(node.get("list", [])) >= 2):
+                    comp_results[digest]["shortened_comp"] = prune_multival_component(
+                        comp=node, seg_tpl=audit_seg["seg_wrk"], baseline_totals=baseline_totals,
+                        _scope_reqs=comp_scope_reqs)
+                comp_results[digest]["report_calls"] = report_call_counter["count"] - calls_before
+
+            if comp_results[digest]["zero_data"]:
+                audit_seg["zero_data_comps"].append(subtree_index[digest]["subtree"])
+            shortened_comp = comp_results[digest]["shortened_comp"]
+            if (shortened_comp is not None) and shortened_comp["pruned"]:
+                # _id, description and value order differ from segment to segment, so only the pruned list is taken over
+                new_definition = copy.deepcopy(node)
+                new_definition["list"] = copy.deepcopy(shortened_comp["new_definition"]["list"])
+                audit_seg["shortened_multival_comps"].append(new_definition)
+
+    # confirm the pruned version of each segment against the data of the original segment
+    confirmation_report = []
+    for audit_seg in audit_segs:
+        seg_report = {"seg_id": audit_seg["seg_id"],
+                      "name": audit_seg["seg_wrk"]["name"],
+                      "pruned_multival_comps": len(audit_seg["shortened_multival_comps"]),
+                      "zero_data_comps": audit_seg["zero_data_comps"]}
+        if len(audit_seg["shortened_multival_comps"]) > 0:
+            pruned_seg = copy.deepcopy(audit_seg["seg_wrk"])
+            for new_definition in audit_seg["shortened_multival_comps"]:
+                pruned_seg = replace_subdict_by_id(d=pruned_seg, subdict_id=new_definition["_id"], key="_id",
+                                                   replace_by=new_definition)
+            delete_keys_from_dict(pruned_seg)
+            seg_scope_reqs = build_scope_reqs(_seg_id=audit_seg["seg_id"])
+            seg_totals = {scope: get_totals(data) for scope, data in
+                          get_scope_reports(_scope_reqs=seg_scope_reqs).items()}
+            result, _ = compare_across_scopes(seg_defi=pruned_seg, _baseline_totals=seg_totals,
+                                              _scope_reqs=seg_scope_reqs)
+            seg_report["confirmed"] = result == "identical"
+            if seg_report["confirmed"]:
+                seg_report["pruned_definition"] = pruned_seg["definition"]
+        confirmation_report.append(seg_report)
+
+    print(f"\n----Audit Summary----\nTop {audit_top_n} shared subtrees:")
+    for entry in top_shared_subtrees[:audit_top_n]:
+        print(f"{entry['occurrences']}x in {len(entry['seg_ids'])} segments ({entry['digest'][:10]}): "
+              f"{dumps(entry['subtree'])}")
+    print(f"\nPer-segment confirmation:\n{dumps(confirmation_report, indent=2)}")
+    print(f"\nEvaluated {len(comp_results)} distinct components with {report_call_counter['count']} report calls in "
+          f"total. Reusing the results of shared components saved {report_calls_saved} report calls.")
+
+
+abs_tolerances, rel_tolerances = build_tolerance_vectors()
+
+if len(audit_seg_ids) > 0:
+    run_audit(_seg_ids=audit_seg_ids)
+    exit()
+
+# get the original segment
+original_seg = ags.getSegment(segment_id=seg_id, full=True)
+
+original_seg_wrk = copy.deepcopy(original_seg)  # working copy
+scope_reqs = build_scope_reqs(_seg_id=seg_id)
+# query the benchmark report of each scope (only once)
+current_data = get_scope_reports(_scope_reqs=scope_reqs)
+print(f"Benchmark data per scope: {dumps(sum_by_scope(current_data), indent=2)}")
+# the baseline totals are computed only once and then compared against every candidate
+current_totals = {scope: get_totals(data) for scope, data in current_data.items()}
 
 assign_ids_recursive(original_seg_wrk)
 
@@ -371,22 +713,6 @@ for i in sorted(alt_definitions_to_pop, reverse=True):
     alt_definitions.pop(i)
 
 # Now pruning the segment definition, starting with multi-value (contains/equals any of) components
-test_seg_tpl = copy.deepcopy(original_seg_wrk)
-test_seg_tpl["name"] = f"Test Segment for multi-value component pruning {dt.datetime.now().strftime('%Y%m%d-%H%M%S')}"
-test_seg_tpl["definition"]["container"] = {
-    "func": "container",
-    "context": "hits",
-    "pred": {}  # this is filled by each round of the loop
-}
-# remove the _id key from the test segment definition to make it valid
-delete_keys_from_dict(test_seg_tpl, _key="_id")
-# in segment definitions, equals any of needs a "," as a separator, contains any of needs a " " as a separator (legacy nonsense)
-delimiter_map = {
-    "contains-any-of": " ",
-    "streq-in": ",",
-    "not-contains-any-of": " ",
-    "not-streq-in": ","
-}
 shortened_multival_comps = []
 multival_comps = 0
 pruned_multival_comps = 0
@@ -411,67 +737,17 @@ for comp in components:
                         f"invalid segment structure. Skipping this component.")
             continue
 
-        baseline_seg = copy.deepcopy(test_seg_tpl)
-        comp_copy = copy.deepcopy(comp)
-        baseline_seg["definition"]["container"]["pred"] = copy.deepcopy(comp_copy)
-        _id = comp_copy.get("_id", -1)
-        if _id == -1:
-            raise Exception(f"Component {comp_copy} has no _id!")
-        delete_keys_from_dict(baseline_seg, _key="_id")
         print("Getting baseline data = data as per current definition")
-        baseline_data = get_comp_report(seg_defi=baseline_seg,
-                                        _req=copy.deepcopy(req))
-        if baseline_data[metric_ids[0]].sum() == 0:
+        baseline_totals = get_component_totals(comp=comp, seg_tpl=original_seg_wrk, _scope_reqs=scope_reqs)
+        if not any(totals.any() for totals in baseline_totals.values()):
             print(
-                "Component currently returns no data, it probably can be removed entirely (which will be examined in a later check). Skipping it.")
+                "Component currently returns no data in any scope, it probably can be removed entirely (which will be examined in a later check). Skipping it.")
             continue
-        _current_metric1 = baseline_data[metric_ids[0]].sum()
-        _current_metric2 = baseline_data[metric_ids[1]].sum()
-
-        shortened_multival_comps.append({"old_definition": copy.deepcopy(comp_copy),
-                                         "new_definition": copy.deepcopy(comp_copy),
-                                         "_id": _id})
-        shortened_multival_comps[-1]["new_definition"]["list"] = []  # clear list first
-        shortened_multival_comps[-1]["old_definition_str"] = delimiter_map[func].join(
-            shortened_multival_comps[-1]["old_definition"]["list"])
-        test_seg_tpl["definition"]["container"]["pred"] = copy.deepcopy(comp_copy)
-        delete_keys_from_dict(
-            test_seg_tpl)  # we are actually evaluating this segment in AA, so the _id keys must go
-        # remove duplicates
-        comp_copy["list"] = list(set(comp_copy["list"]))
-        if len(comp_copy["list"]) < list_len:
-            print(f"Removed {list_len - len(comp_copy['list'])} duplicates from component {var}")
-        list_len_no_dupes = len(comp_copy["list"])  # update list_len with the new length
-
-        original_list = comp_copy["list"].copy()
-        for index, value in enumerate(original_list):
-            value_to_test = original_list[index]
-            print(f"Testing without value: {value_to_test} (value {index + 1} of {list_len})")
-            shorter_list = comp_copy["list"].copy()
-            shorter_list.remove(value_to_test)  # [index + 1:]
-            test_seg_tpl["definition"]["container"]["pred"]["list"] = shorter_list
-            comp_data = get_comp_report(seg_defi=test_seg_tpl, _req=copy.deepcopy(req))
-            result = compare_data(comp_data, baseline_data)
-            if result == "identical":
-                print(f"'{value_to_test}' can be removed from the component without changing the data.")
-                comp_copy["list"].remove(value_to_test)
-            else:  # keep it
-                shortened_multival_comps[-1]["new_definition"]["list"].append(value_to_test)
-                print(f"'{value_to_test}' has to stay in the filter.")
-
-            # we are done iterating through the multi-value lists of the component
-        print(f"Done pruning the {func} values of component {var}")
-        shortened_multival_comps[-1]["new_definition_str"] = delimiter_map[func].join(
-            shortened_multival_comps[-1]["new_definition"]["list"])
-        shortened_multival_comps[-1]["new_definition"]["_id"] = _id  # re-add the ID
-        new_len = len(shortened_multival_comps[-1]["new_definition"]["list"])
-        if new_len == list_len:
-            print(f"Component {var} could not be pruned, all values are needed.")
-            shortened_multival_comps[-1]["pruned"] = False
-        else:
-            print(f"Component {var} can be pruned from {list_len} to {new_len} values.")
-            shortened_multival_comps[-1]["pruned"] = True
-            shortened_multival_comps[-1]["pruned_by"] = list_len - new_len
+
+        shortened_multival_comps.append(prune_multival_component(comp=comp, seg_tpl=original_seg_wrk,
+                                                                 baseline_totals=baseline_totals,
+                                                                 _scope_reqs=scope_reqs))
+        if shortened_multival_comps[-1]["pruned"]:
             pruned_multival_comps += 1
 
 if multival_comps > 0:
@@ -540,11 +816,10 @@ for index, dfi in enumerate(alt_definitions):
     if new_seg.get("errorCode") is not None:
         raise Exception(f"Error validating segment: {new_seg}")
     print(f"Segment validated successfully")
-    comp_data = get_comp_report(seg_defi=this_dfi_seg, _req=copy.deepcopy(req))
-    # compare values to original: if the same, segment component is not needed => will be added to same_data_but_smaller_definitions
-    result = compare_data(comp_data, current_data)
-    dfi[metric_ids[0]] = comp_data[metric_ids[0]].sum()
-    dfi[metric_ids[1]] = comp_data[metric_ids[1]].sum()
+    # compare values to original in every scope: if the same, segment component is not needed => will be added to same_data_but_smaller_definitions
+    result, comp_data = compare_across_scopes(seg_defi=this_dfi_seg, _baseline_totals=current_totals,
+                                              _scope_reqs=scope_reqs)
+    dfi["data_by_scope"] = sum_by_scope(comp_data)
     if result == "identical":
         alt_defs_non_chg.append(dfi)
 
@@ -653,7 +928,6 @@ print(
 # validate each combination against the data
 # since we start with the largest combinations, we can stop if the first combination (all parts) does not change the data
 valid_combo = None
-req_copy = copy.deepcopy(req)
 pruned_seg_combos_copy = copy.deepcopy(pruned_seg_combos)  # debugging
 
 new_seg_ids = []
@@ -671,19 +945,17 @@ for index, seg in enumerate(pruned_seg_combos):
         "name"] = f"Pruned Segment {seg['combo_id']}-{dt.datetime.now().strftime('%Y%m%d-%H%M%S')} of: {pruned_seg_to_eval['name']}"
     # for debugging: uncomment to create a segment for each combination
     # new_seg_ids.append(ags.createSegment(segmentJSON=original_seg_copy))
-    comp_data = get_comp_report(seg_defi=pruned_seg_to_eval, _req=req_copy)
-    # compare values to original: if the same, segment component is not needed => will be added to same_data_but_smaller_definitions
-    result = compare_data(comp_data, current_data)
-    seg[metric_ids[0]] = comp_data[metric_ids[0]].sum()
-    seg[metric_ids[1]] = comp_data[metric_ids[1]].sum()
+    # compare values to original in every scope: if the same, segment component is not needed => will be added to same_data_but_smaller_definitions
+    result, comp_data = compare_across_scopes(seg_defi=pruned_seg_to_eval, _baseline_totals=current_totals,
+                                              _scope_reqs=scope_reqs)
+    seg["data_by_scope"] = sum_by_scope(comp_data)
     if result == "identical":
         print(
             f"Found largest possible non-data-changing combination (index {index}, combo ID {seg['combo_id']}) of parts!")
         valid_combo = {
             "seg_json": pruned_seg_to_eval,
             "combo_id": seg["combo_id"],
-            metric_ids[0]: seg[metric_ids[0]],
-            metric_ids[1]: seg[metric_ids[1]]
+            "data_by_scope": seg["data_by_scope"]
         }
         break
     # otherwise, we try with the next-smallest combination in the list